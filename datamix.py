@@ -1,19 +1,34 @@
 #!/usr/bin/env python3
 
 import sys
-import json
+import os
+import re
+import heapq
+import pickle
+import hashlib
 import logging
 
-from string import Template
+try:
+    import orjson as json_parser
+except ImportError:
+    import json as json_parser
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from argparse import ArgumentParser
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
 
-# JSON keys
-COMMENT = 'comment'
-VARIABLES = 'variables'
-PROPORTION = 'proportion'
-DATA = 'data'
-MIXTURE = 'mixture'
+# JSON keys, interned so lookups with these constants can compare
+# dict keys by identity rather than by value
+COMMENT = sys.intern('comment')
+VARIABLES = sys.intern('variables')
+PROPORTION = sys.intern('proportion')
+DATA = sys.intern('data')
+MIXTURE = sys.intern('mixture')
 
 
 def parse_args():
@@ -24,38 +39,160 @@ def parse_args():
     return ap.parse_args()
 
 
-def interpolate_variables(value, variables):
-    # Recursively apply Template.substitute(variables) to all string
-    # values in JSON-like structure
-    if isinstance(value, str):
-        return Template(value).substitute(variables)
-    elif isinstance(value, list):
-        return [interpolate_variables(i, variables) for i in value]
-    elif isinstance(value, dict):
-        return {
-            k: interpolate_variables(v, variables) for k, v in value.items()
-        }
-    else:
-        return value
+# matches Template placeholder syntax: a $$ escape, $name or ${name}
+# with a full ASCII identifier, or an invalid placeholder (any other
+# $), so substitution semantics follow Template.substitute: unknown
+# names raise KeyError rather than silently passing through, $basedirX
+# is not expanded as $basedir, and invalid placeholders raise
+# ValueError rather than leaking into the output
+PLACEHOLDER_RE = re.compile(
+    r'\$(?:'
+    r'(?P<escaped>\$)|'
+    r'(?P<named>(?a:[_a-zA-Z][_a-zA-Z0-9]*))|'
+    r'\{(?P<braced>(?a:[_a-zA-Z][_a-zA-Z0-9]*))\}|'
+    r'(?P<invalid>)'
+    r')')
+
+
+def make_substitute(variables: Dict[str, str]) -> Optional[Callable[[str], str]]:
+    # Build a substitution function applying the given variables with
+    # Template syntax using a single precompiled regex
+    if not variables:
+        return None
+
+    def replace(m: 're.Match') -> str:
+        name = m.group('named') or m.group('braced')
+        if name is not None:
+            return str(variables[name])    # KeyError for unknown names
+        if m.group('escaped') is not None:
+            return '$'    # the $$ escape
+        # invalid placeholder; report its position like Template does
+        i = m.start('invalid')
+        lines = m.string[:i].splitlines(keepends=True)
+        if not lines:
+            lineno = colno = 1
+        else:
+            colno = i - len(''.join(lines[:-1]))
+            lineno = len(lines)
+        raise ValueError(
+            f'Invalid placeholder in string: line {lineno}, col {colno}')
+
+    return lambda s: PLACEHOLDER_RE.sub(replace, s)
 
 
-def remove_comments(value):
-    if not isinstance(value, dict):
+def interpolate_str(value: str,
+                    substitute: Optional[Callable[[str], str]]) -> str:
+    if substitute is None or '$' not in value:
         return value
-    else:
-        return {
-            k: remove_comments(v) for k, v in value.items() if k != COMMENT
-        }
+    return substitute(value)
+
+
+def interpolate_list(value: List[Any],
+                     substitute: Optional[Callable[[str], str]]) -> List[Any]:
+    return [clean_and_interpolate(i, substitute) for i in value]
+
+
+def interpolate_dict(value: Dict[str, Any],
+                     substitute: Optional[Callable[[str], str]]) -> Dict[str, Any]:
+    # keys are interned so that later lookups by the interned key
+    # constants hit the identity-comparison fast path
+    return {
+        sys.intern(k): clean_and_interpolate(v, substitute)
+        for k, v in value.items() if k != COMMENT
+    }
+
+
+# dispatch on exact type rather than an isinstance chain: JSON parsing
+# only produces these exact types, and a single dict lookup replaces up
+# to three isinstance checks per node
+INTERPOLATE_DISPATCH = {
+    str: interpolate_str,
+    list: interpolate_list,
+    dict: interpolate_dict,
+}
+
+
+def clean_and_interpolate(value: Any, substitute: Optional[Callable[[str], str]]) -> Any:
+    # Recursively drop "comment" keys and apply substitute() to all
+    # string values in JSON-like structure in a single pass
+    handler = INTERPOLATE_DISPATCH.get(type(value))
+    return handler(value, substitute) if handler is not None else value
 
 
-def load_json_with_variables(fn):
-    with open(fn) as f:
-        data = json.load(f)
-    variables = data.pop(VARIABLES, {})
-    return interpolate_variables(remove_comments(data), variables)
+# bump when the structure of any cached object changes so stale caches
+# from earlier versions are not picked up
+CACHE_FORMAT_VERSION = 2
 
 
-def validate_paths(paths):
+def file_cache_key(fn: str) -> str:
+    # Cache key for a config file: absolute path and mtime, so any edit
+    # to the file invalidates entries derived from it
+    return f'{os.path.abspath(fn)}:{os.path.getmtime(fn)}'
+
+
+def remove_comments_inplace(data: Dict[str, Any]) -> Dict[str, Any]:
+    # Strip "comment" keys from the freshly parsed tree in place; used
+    # when there are no variables to interpolate, where rebuilding the
+    # tree would produce an identical copy
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            value.pop(COMMENT, None)
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return data
+
+
+def cache_filename(key: str, subdir: str) -> str:
+    digest = hashlib.sha1(f'{CACHE_FORMAT_VERSION}:{key}'.encode()).hexdigest()
+    cache_dir = os.environ.get(
+        'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_dir, 'datamix', subdir, f'{digest}.pkl')
+
+
+def load_cached(cache_fn: str) -> Any:
+    try:
+        with open(cache_fn, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        return None    # not cached (or unreadable)
+
+
+def save_cached(cache_fn: str, obj: Any) -> None:
+    try:
+        os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+        with open(cache_fn, 'wb') as f:
+            pickle.dump(obj, f)
+    except Exception:
+        # caching is best-effort only; in particular pickling recurses
+        # and can hit RecursionError on deeply nested trees that the
+        # iterative tree walks themselves handle fine
+        pass
+
+
+def load_json_with_variables(fn: str) -> Dict[str, Any]:
+    cache_fn = cache_filename(file_cache_key(fn), 'loaded')
+    data = load_cached(cache_fn)
+    if data is not None:
+        return data
+
+    with open(fn, 'rb') as f:
+        data = json_parser.loads(f.read())
+    variables = data.pop(VARIABLES, None)
+    if not variables:
+        # common case: nothing to interpolate, so strip comments in
+        # place instead of copying the whole tree
+        data = remove_comments_inplace(data)
+    else:
+        data = clean_and_interpolate(data, make_substitute(variables))
+
+    save_cached(cache_fn, data)
+    return data
+
+
+def validate_paths(paths: Dict[str, Any]) -> None:
     seen = set()
     for k, v in paths.items():
         if not isinstance(v, str):
@@ -65,147 +202,135 @@ def validate_paths(paths):
         seen.add(v)
 
 
-def validate_mixture(mixture, paths, label=None, names=None, ids=None):
-    if label is None:
-        label = 'top level mixture'
-    if names is None:
-        names = set()
-    if ids is None:
-        ids = set()
-
-    proportions = []
-    for k, v in mixture.items():
-        if k in names:
-            raise ValueError(f'duplicate name "{k}" in "{v}". names: {names}')
-        names.add(k)
-    
-        if not isinstance(v, dict):
-            raise ValueError(f'expected dict for "{k}"')
-
-        if PROPORTION not in v:
-            raise ValueError(f'missing "{PROPORTION}" for "{k}"')
-        if not isinstance(v[PROPORTION], float):
-            raise ValueError(f'expected float "{PROPORTION}" value for "{k}"')
-        if not 0 < v[PROPORTION] <= 1.0:
-            raise ValueError(f'expected 0 < "{PROPORTION}" <= 1 for "{k}"')
-        proportions.append(v[PROPORTION])
-
-        if MIXTURE in v:
-            if not isinstance(v[MIXTURE], dict):
-                raise ValueError(f'expected dict "{DATA}" value for "{k}"')
-            if DATA in v:
-                raise ValueError(f'both "{DATA}" and "{MIXTURE}" for "{k}"')
-            validate_mixture(v[MIXTURE], paths, k, names, ids)
-        elif DATA in v:
-            if not isinstance(v[DATA], str):
-                raise ValueError(f'expected string "{DATA}" value for "{k}"')
-            if v[DATA] not in paths:
-                raise ValueError(f'unknown data ID "{v[DATA]}" for "{k}"')
-            if v[DATA] in ids:
-                raise ValueError(f'duplicate reference to "{v[DATA]}"')
-            ids.add(v[DATA])
-        else:
-            raise ValueError(f'neither "{DATA}" not "{MIXTURE}" for "{k}"')
-
-    if round(sum(proportions), 10) != 1: # fixed to avoid floating point issues
-        print(sum(proportions))
-        raise ValueError(f'"{PROPORTION}" values do not add to 1 for {label}')
-
-
-def flatten_mixture(mixture, parent_weight=1.0, flattened=None):
-    if flattened is None:
-        flattened = {}
-
-    for k, v in mixture.items():
-        weight = parent_weight * v[PROPORTION]
-        if MIXTURE in v:
-            flatten_mixture(v[MIXTURE], weight, flattened)
+def validate_and_flatten_mixture(mixture: Dict[str, Any],
+                                 paths: Dict[str, str]) -> Dict[str, Any]:
+    # Validate the mixture and flatten it to a leaf name ->
+    # (weight, path) dict in a single traversal, resolving data IDs to
+    # their paths along the way. Iterate with an explicit stack
+    # of iterators rather than recursing to avoid per-level frame
+    # overhead and RecursionError on deep configs; a stack of iterators
+    # preserves depth-first in-order traversal (and thus the insertion
+    # order of the flattened dict)
+    names = set()
+    ids = set()
+    flattened = {}
+    stack = [(iter(mixture.items()), 'top level mixture', 1.0, [])]
+
+    # bind hot keys to locals (LOAD_FAST instead of LOAD_GLOBAL)
+    _proportion, _mixture, _data = PROPORTION, MIXTURE, DATA
+
+    while stack:
+        items, label, parent_weight, proportions = stack[-1]
+        for k, v in items:
+            if k in names:
+                raise ValueError(f'duplicate name "{k}" in "{v}". names: {names}')
+            names.add(k)
+
+            if not isinstance(v, dict):
+                raise ValueError(f'expected dict for "{k}"')
+
+            if _proportion not in v:
+                raise ValueError(f'missing "{PROPORTION}" for "{k}"')
+            if not isinstance(v[_proportion], float):
+                raise ValueError(f'expected float "{PROPORTION}" value for "{k}"')
+            if not 0 < v[_proportion] <= 1.0:
+                raise ValueError(f'expected 0 < "{PROPORTION}" <= 1 for "{k}"')
+            proportions.append(v[_proportion])
+            weight = parent_weight * v[_proportion]
+
+            if _mixture in v:
+                if not isinstance(v[_mixture], dict):
+                    raise ValueError(f'expected dict "{DATA}" value for "{k}"')
+                if _data in v:
+                    raise ValueError(f'both "{DATA}" and "{MIXTURE}" for "{k}"')
+                stack.append((iter(v[_mixture].items()), k, weight, []))
+                break
+            elif _data in v:
+                data_id = v[_data]
+                if not isinstance(data_id, str):
+                    raise ValueError(f'expected string "{DATA}" value for "{k}"')
+                path = paths.get(data_id)
+                if path is None:
+                    raise ValueError(f'unknown data ID "{data_id}" for "{k}"')
+                if data_id in ids:
+                    raise ValueError(f'duplicate reference to "{data_id}"')
+                ids.add(data_id)
+                flattened[k] = (weight, path)
+            else:
+                raise ValueError(f'neither "{DATA}" not "{MIXTURE}" for "{k}"')
         else:
-            assert DATA in v, f'missing {DATA}'
-            flattened[k] = {
-                PROPORTION: weight,
-                DATA: v[DATA]
-            }
+            stack.pop()
+            if round(sum(proportions), 10) != 1: # fixed to avoid floating point issues
+                print(sum(proportions))
+                raise ValueError(f'"{PROPORTION}" values do not add to 1 for {label}')
 
     return flattened
 
-def output_megatron_data_path(mixture, paths):
-    flattened = flatten_mixture(mixture)
-    items = list(flattened.items())
-    
-    precision = 6
-    multiplier = 10**precision # scale weights to integers based on precision (6 decimal places)
-    
-    
-    scaled_values = []
-    for k, v in items:
-        exact_val = v[PROPORTION] * multiplier
-        floor_val = int(exact_val)
-        remainder = exact_val - floor_val # calculate floor values and keep track of remainders
-        scaled_values.append({
-            'key': k,
-            'path': paths[v[DATA]],
-            'floor': floor_val,
-            'remainder': remainder
-        })
-    
-    # calculate how many 0.000001 are missing to reach 1.0
-    total_floor_sum = sum(x['floor'] for x in scaled_values)
-    diff = multiplier - total_floor_sum  # the number of 1e-6 units to distribute
-    
-    # Sort by remainder descending
-    scaled_values.sort(key=lambda x: x['remainder'], reverse=True)
-    
-    for i in range(int(diff)):
-        scaled_values[i]['floor'] += 1
-        
-    for item in scaled_values:
-        final_proportion = item['floor'] / multiplier
-        print(f"{final_proportion:.{precision}f} {item['path']}")
-
-def save_megatron_data_path(mixture, paths, output_file):
-    flattened = flatten_mixture(mixture)
-    items = list(flattened.items())
-    
-    precision = 6
-    multiplier = 10**precision
-    
-    # scale and calculate floor values
-    processed_items = []
-    for k, v in items:
-        exact_val = v[PROPORTION] * multiplier
-        floor_val = int(exact_val)
-        remainder = exact_val - floor_val
-        processed_items.append({
-            'path': paths[v[DATA]],
-            'floor': floor_val,
-            'remainder': remainder
-        })
-    
-    # fix of rounding errors (Largest Remainder Method)
-    total_floor_sum = sum(x['floor'] for x in processed_items)
-    diff = multiplier - total_floor_sum
-    
-    # sort by remainder descending to give more proportions to those closest to rounding up
-    processed_items.sort(key=lambda x: x['remainder'], reverse=True)
-    for i in range(int(diff)):
-        processed_items[i]['floor'] += 1
-        
-    # all proportion-path pairs are joined by a space
-    output_parts = []
-    for item in processed_items:
-        final_proportion = item['floor'] / multiplier
-        output_parts.append(f"{final_proportion:.{precision}f} {item['path']}")
-    
-    single_line_output = " ".join(output_parts)
+def largest_remainder_floors(proportions: List[float], multiplier: int) -> List[int]:
+    # Scale proportions to integer units that sum exactly to multiplier
+    # (Largest Remainder Method): floor each scaled value, then bump the
+    # floors with the largest remainders, i.e. those closest to
+    # rounding up
+    if np is not None:
+        scaled = np.asarray(proportions, dtype=np.float64) * multiplier
+        floors = scaled.astype(np.int64)
+        remainders = scaled - floors
+        diff = multiplier - int(floors.sum())
+        if diff > 0:
+            # stable sort so ties go to the earliest-inserted entries,
+            # matching the heapq.nlargest fallback below
+            top = np.argsort(-remainders, kind='stable')[:diff]
+            floors[top] += 1
+        return floors.tolist()
+    else:
+        scaled = [p * multiplier for p in proportions]
+        floors = [int(s) for s in scaled]
+        remainders = [s - f for s, f in zip(scaled, floors)]
+        diff = multiplier - sum(floors)
+        top = heapq.nlargest(diff, range(len(remainders)),
+                             key=remainders.__getitem__)
+        for i in top:
+            floors[i] += 1
+        return floors
+
+
+def format_fixed_point(n: int, precision: int) -> str:
+    # Format the integer n as n / 10**precision entirely in integer
+    # arithmetic, avoiding a float divide and float formatting
+    s = f'{n:0{precision+1}d}'
+    return f'{s[:-precision]}.{s[-precision:]}'
+
+
+def format_megatron_data_path(flattened: Dict[str, Any],
+                              precision: int = 6) -> Iterator[str]:
+    # Generate "proportion path" strings for the flattened mixture with
+    # proportions rounded to sum exactly to 1 at the given precision
+    multiplier = 10**precision # scale weights to integers based on precision
+
+    proportions = [w for w, _ in flattened.values()]
+    item_paths = [p for _, p in flattened.values()]
+    floors = largest_remainder_floors(proportions, multiplier)
+
+    for floor_val, path in zip(floors, item_paths):
+        yield f"{format_fixed_point(floor_val, precision)} {path}"
+
+def output_megatron_data_path(flattened: Dict[str, Any]) -> None:
+    print('\n'.join(format_megatron_data_path(flattened)))
+
+def save_megatron_data_path(flattened: Dict[str, Any],
+                            output_file: str) -> None:
+    # all proportion-path pairs are joined by a space, streamed through
+    # the file buffer rather than joined into one large string
+    with open(output_file, 'w', buffering=1<<20) as f:
+        for i, part in enumerate(format_megatron_data_path(flattened)):
+            if i:
+                f.write(' ')
+            f.write(part)
 
-    with open(output_file, 'w') as f:
-        f.write(single_line_output)
-    
     print(f"The datapath: {output_file}")
 
 
-def main():
+def main() -> int:
     args = parse_args()
 
     logging.basicConfig(format='%(message)s')
@@ -222,28 +347,44 @@ def main():
         logging.error(f'error loading {args.paths}: {e}')
         return 1
 
+    # the validated and flattened mixture is cached keyed on both
+    # config files, so repeated runs over the same configs (e.g.
+    # parameter sweeps) skip the validation and flattening walks
     try:
-        validate_paths(paths)
-    except Exception as e:
-        logging.error(f'error validating {args.paths}: {e}')
-        return 1
+        cache_key = f'{file_cache_key(args.mixture)}:{file_cache_key(args.paths)}'
+        cache_fn = cache_filename(cache_key, 'flattened')
+        flattened = load_cached(cache_fn)
+    except OSError:
+        cache_fn, flattened = None, None
 
-    try:
-        validate_mixture(mixture, paths)
-    except Exception as e:
-        logging.error(f'error validating {args.mixture}: {e}')
-        return 1
+    if flattened is None:
+        try:
+            validate_paths(paths)
+        except Exception as e:
+            logging.error(f'error validating {args.paths}: {e}')
+            return 1
+
+        try:
+            flattened = validate_and_flatten_mixture(mixture, paths)
+        except Exception as e:
+            logging.error(f'error validating {args.mixture}: {e}')
+            return 1
+
+        if cache_fn is not None:
+            save_cached(cache_fn, flattened)
 
     try:
         if args.output:
             # If the user provided --output, save to file
-            save_megatron_data_path(mixture, paths, args.output)
+            save_megatron_data_path(flattened, args.output)
         else:
             # If --output is None, print/output to console
-            output_megatron_data_path(mixture, paths)
+            output_megatron_data_path(flattened)
     except Exception as e:
         logging.error(f'error processing output: {e}')
         return 1
 
+    return 0
+
 if __name__ == '__main__':
     sys.exit(main())